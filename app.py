@@ -1,71 +1,256 @@
 """
 BehavioralDNA - Backend Server
 Flask + Scikit-learn Isolation Forest for anomaly detection
-Run: python app.py
+Run: gunicorn app:app   (see gunicorn.conf.py)
+     python app.py       (local development)
 """
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import json, os, csv
+from flask_caching import Cache
+import os, csv, queue, time, atexit, sqlite3
+import orjson
+import msgspec
 from datetime import datetime
-from ml_model import BehavioralModel
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from ml_model import BehavioralModel, FEATURES_USED
 
 app = Flask(__name__)
 CORS(app)  # Allow frontend to call API
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 
-DATA_FILE = "enrolled_profiles.json"
+DB_FILE   = "profiles.db"
+DATA_FILE = "enrolled_profiles.json"   # legacy JSON store, imported once into DB_FILE
 LOG_FILE  = "login_log.csv"
+LOG_HEADER = ["timestamp","username","status","score",
+              "avg_interval","avg_hold_time","typing_speed",
+              "backspace_count","total_keys","mouse_speed"]
+DB_RETRY_DELAY = 1.0   # seconds between attempts to insert a failed session batch
+WRITE_BATCH = 100   # max rows per background write (log file and session inserts)
+RETRAIN_EVERY = 10    # retrain after this many new sessions (or when the data doubles)
 
 model = BehavioralModel()
 
+def _get_batch(q, limit):
+    """Block for one item, then drain whatever else is already waiting (up to limit)."""
+    buf = [q.get()]
+    while len(buf) < limit:
+        try:
+            buf.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return buf
+
+_STOP = object()   # queued at exit so a writer thread finishes its rows and returns
+STOP_TIMEOUT = 10.0   # seconds to wait at exit for a writer thread to finish
+
+def _run_writer(q, write):
+    while True:
+        buf = _get_batch(q, WRITE_BATCH)
+        rows = [r for r in buf if r is not _STOP]
+        if rows:
+            try:
+                write(rows)
+            except Exception as e:
+                # Keep the thread alive; one bad write must not stop all later ones
+                print(f"[IO] Background write failed, dropped {len(rows)} rows: {e}")
+        if len(rows) != len(buf):
+            return
+
+def _start_writer(q, write):
+    """
+    Drain q into write(rows) on a daemon thread. At exit, queue _STOP and
+    join, so rows still queued or already taken off the queue get written.
+    """
+    thread = Thread(target=_run_writer, args=(q, write), daemon=True)
+    thread.start()
+    def stop():
+        if not thread.is_alive():
+            return
+        try:
+            q.put(_STOP, timeout=STOP_TIMEOUT)
+        except queue.Full:
+            print("[IO] Writer queue still full at exit; pending rows are lost.")
+            return
+        thread.join(STOP_TIMEOUT)
+    atexit.register(stop)
+
+# ─── Profiles: one SQLite row per enrolled session ───
+def _open_db():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS sessions (username TEXT NOT NULL, ts REAL NOT NULL, "
+                 + ", ".join(f"{f} REAL" for f in FEATURES_USED) + ")")
+    return conn
+
+_db = _open_db()   # after load_profiles() only the session writer thread uses it
+_INSERT_SESSION = (f"INSERT INTO sessions (username, ts, {', '.join(FEATURES_USED)}) "
+                   f"VALUES ({', '.join('?' * (len(FEATURES_USED) + 2))})")
+
+def _session_row(username, features, ts):
+    return (username, ts, *(features.get(f, 0) for f in FEATURES_USED))
+
 # ─── Load existing profiles on startup ───────────────
 def load_profiles():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    if _db.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is None and os.path.exists(DATA_FILE):
+        # First start after the move from JSON: import the old file once
+        with open(DATA_FILE, 'rb') as f:
+            legacy = orjson.loads(f.read())
+        now = time.time()
+        with _db:
+            _db.executemany(_INSERT_SESSION, [_session_row(u, s, now)
+                                              for u, sessions in legacy.items() for s in sessions])
+
+    profiles = {}
+    for username, *values in _db.execute(
+            f"SELECT username, {', '.join(FEATURES_USED)} FROM sessions ORDER BY rowid"):
+        profiles.setdefault(username, []).append(dict(zip(FEATURES_USED, values)))
+    return profiles
+
+# Enroll only queues the new row; the writer thread inserts batches in one transaction
+_session_q = queue.Queue()
+_profiles_lock = Lock()
 
-def save_profiles(profiles):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(profiles, f, indent=2)
+def _insert_sessions(rows):
+    # Retry the same batch until it lands (e.g. "database is locked" from
+    # another connection): these enrolls were already acknowledged
+    while True:
+        try:
+            with _db:
+                _db.executemany(_INSERT_SESSION, rows)
+            return
+        except sqlite3.Error as e:
+            print(f"[DB] Could not save {len(rows)} sessions ({e}); retrying in {DB_RETRY_DELAY}s.")
+            time.sleep(DB_RETRY_DELAY)
+
+# ─── Login log: rows are queued and written by a background thread ───
+_log_q = queue.Queue(maxsize=10000)
+
+# Opened once at startup; after the header only the writer thread writes to it
+_log_fh = open(LOG_FILE, 'a', newline='')
+_log_writer = csv.writer(_log_fh)
+if _log_fh.tell() == 0:   # new (or empty) file
+    _log_writer.writerow(LOG_HEADER)
+    _log_fh.flush()
+
+def _write_log_rows(rows):
+    # Timestamp and score are formatted here, off the request path
+    _log_writer.writerows(
+        (datetime.fromtimestamp(ts).isoformat(), username, status, f"{score:.4f}", *rest)
+        for ts, username, status, score, *rest in rows)
+    _log_fh.flush()
+    # New rows are on disk; drop the cached /logs response
+    with app.app_context():
+        cache.delete('view//logs')
+
+_start_writer(_log_q, _write_log_rows)
 
 def log_attempt(username, features, status, score):
-    file_exists = os.path.exists(LOG_FILE)
-    with open(LOG_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["timestamp","username","status","score",
-                             "avg_interval","avg_hold_time","typing_speed",
-                             "backspace_count","total_keys","mouse_speed"])
-        writer.writerow([
-            datetime.now().isoformat(), username, status, f"{score:.4f}",
+    try:
+        _log_q.put_nowait((
+            time.time(), username, status, score,
             features.get("avg_interval",0), features.get("avg_hold_time",0),
             features.get("typing_speed",0), features.get("backspace_count",0),
             features.get("total_keys",0), features.get("mouse_speed",0)
-        ])
+        ))
+    except queue.Full:
+        print("[LOG] Log queue full, dropping entry.")
 
 profiles = load_profiles()
+# Per-user running feature stats for the z-score fallback, kept in step with profiles
+stats = {u: model.user_stats(s) for u, s in profiles.items()}
+model.add_sessions([s for sessions in profiles.values() for s in sessions])
+_start_writer(_session_q, _insert_sessions)
+
+# Session count the current model was trained on (0 = needs training);
+# saved with the model, since it may be older than the stored sessions
+_trained_at = model.n_trained
+
+def _should_retrain(total):
+    if total < 3:
+        return False
+    return total >= _trained_at * 2 or total - _trained_at >= RETRAIN_EVERY
+
+# Training runs on a single background worker; at most one fit in flight
+_train_executor = ThreadPoolExecutor(max_workers=1)
+_train_running = False
+
+def _maybe_retrain():
+    """Submit a fit on the current sessions if one is due and none is running.
+    Caller holds _profiles_lock."""
+    global _train_running
+    if not _train_running and _should_retrain(model.n_sessions):
+        _train_running = True
+        _train_executor.submit(_train_in_background, model.session_matrix())
+
+def _train_in_background(X):
+    global _trained_at, _train_running
+    ok = False
+    try:
+        model.train(X)
+        ok = True
+    except Exception as e:
+        print(f"[ML] Background training failed: {e}")
+    with _profiles_lock:
+        _train_running = False
+        # n_trained only moves when a new forest is published, so a failed fit
+        # stays due and is retried on the next enroll
+        _trained_at = model.n_trained
+        if ok:
+            # Sessions enrolled while this fit ran are not in X; fit again if now due
+            _maybe_retrain()
+
+# No saved model (or one from another sklearn version): fit on the stored
+# sessions now rather than waiting for the next enroll
+with _profiles_lock:
+    _maybe_retrain()
+
+# ─── Request bodies ───────────────────────────────────
+# Only the model's features are validated (missing ones default to 0);
+# any other keys a client sends are ignored, as before. Counts keep the
+# int the client sent, so the CSV and profiles.db still store 25, not 25.0
+_COUNT_FEATURES = {"backspace_count", "total_keys"}
+SessionFeatures = msgspec.defstruct("SessionFeatures", [
+    (f, int | float, 0) if f in _COUNT_FEATURES else (f, float, 0.0)
+    for f in FEATURES_USED
+])
+
+class SessionRequest(msgspec.Struct):
+    username: str = ""
+    features: SessionFeatures = msgspec.field(default_factory=SessionFeatures)
+
+_session_decoder = msgspec.json.Decoder(SessionRequest)
+_batch_decoder   = msgspec.json.Decoder(list[SessionRequest])
+
+@app.errorhandler(msgspec.DecodeError)   # also covers msgspec.ValidationError
+def bad_request_body(e):
+    return jsonify({"error": f"invalid request body: {e}"}), 400
 
 # ─── Enroll Route ─────────────────────────────────────
 @app.route('/enroll', methods=['POST'])
 def enroll():
-    data = request.json
-    username = data.get('username', '').strip().lower()
-    features = data.get('features', {})
+    body = _session_decoder.decode(request.get_data())
+    username = body.username.strip().lower()
+    features = msgspec.structs.asdict(body.features)
 
     if not username:
         return jsonify({"error": "username required"}), 400
 
-    if username not in profiles:
-        profiles[username] = []
+    with _profiles_lock:
+        # stats first: _detect looks a user up in profiles before reading stats
+        stats[username] = model.update_user_stats(
+            stats.get(username) or model.user_stats([]), features)
+        if username not in profiles:
+            profiles[username] = []
+        profiles[username].append(features)
+        model.add_sessions([features])
+        _session_q.put(_session_row(username, features, time.time()))
 
-    profiles[username].append(features)
-    save_profiles(profiles)
-
-    # Retrain model if enough sessions
-    all_sessions = [s for sessions in profiles.values() for s in sessions]
-    if len(all_sessions) >= 3:
-        model.train(all_sessions)
+        # Retrain model once enough new sessions have accumulated
+        # (if a fit is still running, it re-checks when it finishes)
+        _maybe_retrain()
 
     return jsonify({
         "status": "enrolled",
@@ -74,49 +259,79 @@ def enroll():
     })
 
 # ─── Login / Detect Route ────────────────────────────
-@app.route('/login', methods=['POST'])
-def login():
-    data = request.json
-    username = data.get('username', '').strip().lower()
-    features = data.get('features', {})
+def _detect(attempts):
+    """
+    Score a list of (username, features) login attempts with a single
+    model.predict_many call. Returns one response dict per attempt, in order.
+    """
+    responses = [None] * len(attempts)
+    pending = []
+    for i, (username, features) in enumerate(attempts):
+        if not username:
+            responses[i] = {"error": "username required"}
+        elif username not in profiles or len(profiles[username]) < 2:
+            responses[i] = {
+                "status": "insufficient_data",
+                "message": "Not enough enrolled sessions. Please enroll more.",
+                "score": 0
+            }
+        else:
+            pending.append(i)
 
-    if not username:
-        return jsonify({"error": "username required"}), 400
+    if pending:
+        # Run ML prediction
+        results = model.predict_many(
+            [attempts[i][1] for i in pending],
+            [stats[attempts[i][0]] for i in pending]
+        )
+        for i, result in zip(pending, results):
+            username, features = attempts[i]
+            status = result['status']
+            score  = result['score']
 
-    if username not in profiles or len(profiles[username]) < 2:
-        return jsonify({
-            "status": "insufficient_data",
-            "message": "Not enough enrolled sessions. Please enroll more.",
-            "score": 0
-        })
+            log_attempt(username, features, status, score)
 
-    # Run ML prediction
-    result = model.predict(features, profiles[username])
-    status = result['status']
-    score  = result['score']
+            responses[i] = {
+                "username": username,
+                "status": status,   # 'normal' or 'anomaly'
+                "score": score,
+                "message": result['message']
+            }
+    return responses
 
-    log_attempt(username, features, status, score)
+@app.route('/login', methods=['POST'])
+def login():
+    body = _session_decoder.decode(request.get_data())
+    username = body.username.strip().lower()
+    features = msgspec.structs.asdict(body.features)
 
-    return jsonify({
-        "username": username,
-        "status": status,   # 'normal' or 'anomaly'
-        "score": score,
-        "message": result['message']
-    })
+    response = _detect([(username, features)])[0]
+    if "error" in response:
+        return jsonify(response), 400
+    return jsonify(response)
+
+@app.route('/login_batch', methods=['POST'])
+def login_batch():
+    attempts = [(item.username.strip().lower(), msgspec.structs.asdict(item.features))
+                for item in _batch_decoder.decode(request.get_data())]
+    return jsonify(_detect(attempts))
 
 # ─── View logs route (for demo dashboard) ───────────
+def _json_response(obj):
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 @app.route('/logs', methods=['GET'])
+@cache.cached(timeout=5)
 def get_logs():
-    if not os.path.exists(LOG_FILE):
-        return jsonify([])
-    with open(LOG_FILE, 'r') as f:
+    # LOG_FILE is created (with its header) at startup
+    with open(LOG_FILE, 'r', newline='') as f:
         reader = csv.DictReader(f)
-        return jsonify(list(reader))
+        return _json_response(list(reader))
 
 @app.route('/profiles', methods=['GET'])
 def get_profiles():
-    return jsonify({u: len(s) for u, s in profiles.items()})
+    return _json_response({u: len(s) for u, s in profiles.items()})
 
 if __name__ == '__main__':
     print("🔐 BehavioralDNA Server starting on http://127.0.0.1:5000")
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(port=5000, threaded=True)
\ No newline at end of file
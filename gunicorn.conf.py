@@ -0,0 +1,17 @@
+"""
+BehavioralDNA - Gunicorn config
+Run: gunicorn app:app   (picks this file up automatically)
+"""
+
+bind = "127.0.0.1:5000"
+
+# One worker process: profiles, per-user stats, the model and the log/profile
+# writer threads all live in memory, and separate workers would each keep
+# their own diverging copy. Concurrency comes from threads instead.
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+# No preload: the background threads are started when app.py is imported
+# and would not survive the fork into the worker.
+preload_app = False
@@ -5,9 +5,14 @@ Falls back to statistical z-score method when data is insufficient.
 """
 
 import numpy as np
+import sklearn
 from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-import joblib, os
+from sklearn.ensemble._iforest import _average_path_length
+from sklearn.tree import ExtraTreeRegressor
+from sklearn.tree._tree import Tree
+import json, os
+from functools import lru_cache
+from threading import Lock
 
 FEATURES_USED = [
     "avg_interval",       # milliseconds between keystrokes
@@ -20,80 +25,168 @@ FEATURES_USED = [
 
 ANOMALY_THRESHOLD = 0.3   # Isolation Forest score < -threshold → anomaly
 Z_SCORE_THRESHOLD = 2.5   # Standard deviations for z-score fallback
+SCORE_CACHE_SIZE  = 4096  # memoized Isolation Forest scores for repeated sessions
+MODEL_FILE = "model.npz"  # raw per-tree arrays, see _save/_load
 
 class BehavioralModel:
     def __init__(self):
         self.model = None
-        self.scaler = StandardScaler()
-        self.is_trained = False
+        self.n_trained = 0   # sessions the current forest was fit on
+        self._model_version = 0   # bumped on every new forest; part of the score cache key
+        # Feature matrix of every enrolled session; rows [0, _n) are live and
+        # capacity doubles as it fills, so enrolling never rebuilds it
+        self._X = np.empty((0, len(FEATURES_USED)), dtype=np.float32)
+        self._n = 0
+        self._X_lock = Lock()
+        self._score_cached = lru_cache(maxsize=SCORE_CACHE_SIZE)(self._score_one)
         # Load if already saved
-        if os.path.exists("model.pkl"):
+        if os.path.exists(MODEL_FILE):
             self._load()
 
-    def _extract(self, session: dict) -> list:
-        """Extract feature vector from a session dict."""
-        return [float(session.get(f, 0)) for f in FEATURES_USED]
+    def _stack(self, sessions: list) -> np.ndarray:
+        """Stack session dicts into a contiguous (n_sessions, n_features) float32 matrix."""
+        n_features = len(FEATURES_USED)
+        return np.fromiter(
+            (float(s.get(f, 0)) for s in sessions for f in FEATURES_USED),
+            dtype=np.float32, count=len(sessions) * n_features
+        ).reshape(-1, n_features)
 
-    def train(self, sessions: list):
-        """Train Isolation Forest on all enrolled sessions."""
-        X = np.array([self._extract(s) for s in sessions])
+    def add_sessions(self, sessions: list):
+        """Append enrolled sessions to the training matrix in O(len(sessions)) amortized."""
+        rows = self._stack(sessions)
+        with self._X_lock:
+            end = self._n + len(rows)
+            if end > len(self._X):
+                grown = np.empty((max(end, 2 * len(self._X), 16), len(FEATURES_USED)), dtype=np.float32)
+                grown[:self._n] = self._X[:self._n]
+                self._X = grown
+            self._X[self._n:end] = rows
+            self._n = end
+
+    @property
+    def n_sessions(self) -> int:
+        return self._n
+
+    def session_matrix(self) -> np.ndarray:
+        """
+        Snapshot of all enrolled sessions (a view, no copy). Later appends
+        only write past its end or into a new buffer, so it stays valid.
+        """
+        with self._X_lock:
+            return self._X[:self._n]
+
+    def train(self, X: np.ndarray):
+        """Train Isolation Forest on a session_matrix() snapshot."""
+        # sklearn's trees work on float32 input; matching it means neither
+        # fit nor score_samples has to make a converted copy of the data
+        X = np.asarray(X, dtype=np.float32)
         if X.shape[0] < 3:
             return  # Not enough data yet
 
-        X_scaled = self.scaler.fit_transform(X)
-        self.model = IsolationForest(
+        # No scaling: tree splits are axis-aligned, so standardizing the
+        # features would only move the thresholds, not the isolation paths
+        forest = IsolationForest(
             n_estimators=100,
             contamination=0.1,    # expect ~10% anomalies
-            random_state=42
+            random_state=42,
+            n_jobs=-1             # fit/score trees on all cores
         )
-        self.model.fit(X_scaled)
-        self.is_trained = True
+        forest.fit(X)
+        # Publish only the fully fitted forest, so train() can run on a
+        # background thread while predictions keep using the previous one
+        self.model = forest
+        self.n_trained = X.shape[0]
+        self._model_version += 1           # after self.model, see predict_many
+        self._score_cached.cache_clear()   # drop scores from the previous forest
         self._save()
-        print(f"[ML] Model trained on {len(sessions)} sessions.")
+        print(f"[ML] Model trained on {X.shape[0]} sessions.")
+
+    def user_stats(self, sessions: list) -> dict:
+        """Running per-user feature statistics: { n, mean, M2, inv_std } (Welford)."""
+        X = self._stack(sessions).astype(np.float64)
+        mean = X.mean(axis=0) if len(sessions) else np.zeros(len(FEATURES_USED))
+        return self._stats_dict(len(sessions), mean, ((X - mean) ** 2).sum(axis=0))
 
-    def predict(self, new_session: dict, user_sessions: list) -> dict:
+    def update_user_stats(self, stats: dict, session: dict) -> dict:
         """
+        Fold one new session into user_stats() output in O(features).
+        Returns a new dict so concurrent readers never see a half-updated one.
+        """
+        x = self._stack([session])[0].astype(np.float64)
+        n = stats["n"] + 1
+        delta = x - stats["mean"]
+        mean  = stats["mean"] + delta / n
+        return self._stats_dict(n, mean, stats["M2"] + delta * (x - mean))
+
+    def _stats_dict(self, n: int, mean: np.ndarray, M2: np.ndarray) -> dict:
+        # 1 / population std, precomputed so scoring is a single multiply
+        inv_std = 1.0 / (np.sqrt(M2 / max(n, 1)) + 1e-6)  # avoid div by zero
+        return {"n": n, "mean": mean, "M2": M2, "inv_std": inv_std}
+
+    def predict(self, new_session: dict, user_stats: dict) -> dict:
+        """
+        user_stats: the user's user_stats() dict (used by the z-score fallback).
         Returns:
           { status: 'normal'|'anomaly', score: float 0-1, message: str }
         Score close to 1.0 = high anomaly risk.
         """
-        if self.is_trained and self.model is not None:
-            return self._predict_isolation_forest(new_session)
+        return self.predict_many([new_session], [user_stats])[0]
+
+    def predict_many(self, sessions_list: list, user_stats_list: list) -> list:
+        """
+        Batch version of predict(). user_stats_list[i] holds the user_stats()
+        of whoever produced sessions_list[i] (used by the z-score fallback).
+        Returns one result dict per session, in order.
+        """
+        # Version before model: train() publishes the forest first, so the
+        # forest read here is at least as new as the version
+        version = self._model_version
+        model = self.model   # one read, in case a retrain swaps it meanwhile
+        if model is not None:
+            return self._predict_isolation_forest(model, version, sessions_list)
         else:
-            return self._predict_zscore(new_session, user_sessions)
+            return [self._predict_zscore(s, u) for s, u in zip(sessions_list, user_stats_list)]
 
-    def _predict_isolation_forest(self, session: dict) -> dict:
-        x = np.array([self._extract(session)])
-        x_scaled = self.scaler.transform(x)
+    def _score_one(self, key: bytes, model_version: int) -> tuple:
+        # model_version only keys the cache; the score comes from the current
+        # forest, returned with its offset_ so the anomaly rule stays consistent
+        model = self.model
+        x = np.frombuffer(key, dtype=np.float32).reshape(1, -1)
+        return float(model.score_samples(x)[0]), model.offset_
 
+    def _predict_isolation_forest(self, model: IsolationForest, version: int, sessions_list: list) -> list:
+        X = self._stack(sessions_list)
         # score_samples returns negative values; more negative = more anomalous
-        raw_score = self.model.score_samples(x_scaled)[0]
+        if len(sessions_list) == 1:
+            # Single logins are often exact replays of the same session; memoize them
+            raw, offset = self._score_cached(X.tobytes(), version)
+            raws = np.array([raw])
+        else:
+            raws, offset = model.score_samples(X), model.offset_
         # Normalize to 0–1 range (0 = normal, 1 = very anomalous)
         # Typical range is roughly -0.8 to -0.3
-        normalized = np.clip((-raw_score - 0.3) / 0.5, 0, 1)
-        prediction = self.model.predict(x_scaled)[0]  # 1=normal, -1=anomaly
+        normalized = np.clip((-raws - 0.3) / 0.5, 0, 1)
+        # Same rule as model.predict() (-1 when score_samples - offset_ < 0),
+        # without scoring the batch a second time
+        anomalies = raws < offset
 
-        is_anomaly = prediction == -1
-        return {
+        return [{
             "status": "anomaly" if is_anomaly else "normal",
-            "score": float(normalized),
+            "score": float(score),
             "message": "Anomaly detected by Isolation Forest." if is_anomaly
                        else "Behavioral pattern within normal range.",
             "method": "isolation_forest"
-        }
+        } for score, is_anomaly in zip(normalized, anomalies)]
 
-    def _predict_zscore(self, session: dict, user_sessions: list) -> dict:
+    def _predict_zscore(self, session: dict, user_stats: dict) -> dict:
         """Fallback: compare new session to user's own enrolled sessions via z-score."""
-        if len(user_sessions) < 2:
+        n = user_stats["n"]
+        if n < 2:
             return {"status": "normal", "score": 0.0, "message": "Insufficient data.", "method": "none"}
 
-        X_user = np.array([self._extract(s) for s in user_sessions])
-        x_new  = np.array(self._extract(session))
-
-        means = X_user.mean(axis=0)
-        stds  = X_user.std(axis=0) + 1e-6  # avoid div by zero
+        x_new = self._stack([session])[0]
 
-        z_scores = np.abs((x_new - means) / stds)
+        z_scores = np.abs((x_new - user_stats["mean"]) * user_stats["inv_std"])
         max_z = z_scores.max()
         avg_z = z_scores.mean()
 
@@ -109,14 +202,83 @@ class BehavioralModel:
         }
 
     def _save(self):
-        joblib.dump({"model": self.model, "scaler": self.scaler}, "model.pkl")
+        """
+        Save the forest as plain arrays (no pickle): every tree's node table and
+        leaf values concatenated, with per-tree offsets, plus a JSON header with
+        the forest-level fitted attributes. The node layout and the attributes
+        restored in _load are sklearn internals, so the header records the
+        sklearn version and _load refuses files from a different one.
+        """
+        forest = self.model
+        states = [est.tree_.__getstate__() for est in forest.estimators_]
+        meta = {
+            "sklearn_version": sklearn.__version__,
+            "params": forest.get_params(),
+            "n_features_in": int(forest.n_features_in_),
+            "max_features": int(forest._max_features),
+            "max_samples": int(forest.max_samples_),
+            "offset": float(forest.offset_),
+            "n_samples": self.n_trained,
+            "max_depths": [int(st["max_depth"]) for st in states],
+        }
+        tmp = MODEL_FILE + ".tmp.npz"
+        np.savez(
+            tmp,
+            meta=np.array(json.dumps(meta)),
+            nodes=np.concatenate([st["nodes"] for st in states]),
+            values=np.concatenate([st["values"] for st in states]),
+            node_offsets=np.cumsum([0] + [len(st["nodes"]) for st in states]),
+            estimators_features=np.asarray(forest.estimators_features_),
+        )
+        os.replace(tmp, MODEL_FILE)
 
     def _load(self):
         try:
-            data = joblib.load("model.pkl")
-            self.model  = data["model"]
-            self.scaler = data["scaler"]
-            self.is_trained = True
+            with np.load(MODEL_FILE, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                if meta.get("sklearn_version") != sklearn.__version__:
+                    print(f"[ML] {MODEL_FILE} was saved with scikit-learn {meta.get('sklearn_version')}, "
+                          f"running {sklearn.__version__}; retraining from the stored sessions.")
+                    return
+                nodes, values = data["nodes"], data["values"]
+                offsets = data["node_offsets"]
+                features = data["estimators_features"]
+
+            n_features = meta["n_features_in"]
+            estimators = []
+            for i, max_depth in enumerate(meta["max_depths"]):
+                # Same steps unpickling takes: a fresh single-output Tree, then its state
+                start, end = offsets[i], offsets[i + 1]
+                tree = Tree(n_features, np.ones(1, dtype=np.intp), 1)
+                tree.__setstate__({
+                    "max_depth": max_depth,
+                    "node_count": int(end - start),
+                    "nodes": nodes[start:end],
+                    "values": values[start:end],
+                })
+                est = ExtraTreeRegressor(max_features=1, splitter="random")
+                est.tree_ = tree
+                est.n_features_in_ = n_features
+                est.n_outputs_ = 1
+                estimators.append(est)
+
+            # Rebuild the fitted forest directly instead of fitting a dummy one
+            forest = IsolationForest(**meta["params"])
+            forest.estimators_ = estimators
+            forest.estimators_features_ = list(features)
+            forest.n_features_in_ = n_features
+            forest._max_features = meta["max_features"]
+            forest.max_samples_ = forest._max_samples = meta["max_samples"]
+            forest.offset_ = meta["offset"]
+            if hasattr(Tree, "compute_node_depths"):
+                # Per-tree lookup tables that newer sklearn derives from tree_ in fit()
+                forest._average_path_length_per_tree, forest._decision_path_lengths = zip(*[
+                    (_average_path_length(est.tree_.n_node_samples), est.tree_.compute_node_depths())
+                    for est in estimators
+                ])
+
+            self.model = forest
+            self.n_trained = meta.get("n_samples", 0)   # 0: unknown, retrain soon
             print("[ML] Loaded saved model.")
         except Exception as e:
             print(f"[ML] Could not load model: {e}")
\ No newline at end of file